@@ -1,25 +1,34 @@
 # Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
 
 import argparse
+import json
 import math
 import os
-import random
 import time
+from concurrent.futures import ThreadPoolExecutor
 from sys import platform
 
-import cv2
 import numpy as np
 import scipy.io
 import torch
 from torch import nn
 
-from models import Darknet
-from utils.datasets import ImageFolder
+from models import Darknet, parse_model_config, receptive_field
+from utils.datasets import RGB_MEAN, RGB_STD, ImageFolder, occupied_tiles, plan_strips, plan_tiles
 from utils.utils import (
+    StreamingNMS,
+    compare_detections,
+    fuse_conv_and_bn,
     load_classes,
     non_max_suppression,
-    plot_one_box,
-    xview_indices2classes,
+    parse_classes,
+    parse_formats,
+    prior_bounds,
+    render_detections,
+    str2bool,
+    tile_prior_filter,
+    time_forward,
+    write_detections,
 )
 
 targets_path = "utils/targets_c60.mat"
@@ -31,33 +40,86 @@ parser.add_argument("-output_folder", type=str, default="./output", help="path t
 cuda = torch.cuda.is_available() if platform == "darwin" else False
 # python3 detect.py -plot_flag 1
 parser.add_argument("-plot_flag", type=bool, default=True)
+parser.add_argument("-plot_scale", type=float, default=1.0, help="plot_flag image scale, e.g. 0.25 for a preview")
+parser.add_argument("-plot_pyramid", type=str2bool, default=False, help="plot_flag also writes a 256 px tile pyramid")
 parser.add_argument("-secondary_classifier", type=bool, default=False)
+parser.add_argument("-secondary_conf", type=float, default=1.0, help="reclassify at or below this class prob")
+parser.add_argument("-secondary_margin", type=float, default=0.0, help="also reclassify below this top-2 margin")
+parser.add_argument("-fold_normalization", type=str2bool, default=True, help="absorb RGB mean/std into the first conv")
+parser.add_argument("-fuse", type=str2bool, default=True, help="fold BatchNorm into conv weights for inference")
+parser.add_argument("-channels_last", type=str2bool, default=True, help="-fuse classifier in channels-last layout")
+parser.add_argument("-script_classifier", type=str2bool, default=False, help="run classifier as frozen TorchScript")
+parser.add_argument("-benchmark", type=str2bool, default=False, help="report per-tile forward time of model options")
+parser.add_argument("-quantize", type=str2bool, default=False, help="int8 static quantization of the conv stack (CPU)")
+parser.add_argument("-calibration_tiles", type=int, default=8, help="number of tiles to calibrate -quantize on")
+parser.add_argument("-reference", type=str, default="", help="results .txt to compare detections against")
+parser.add_argument("-tile_priors", type=str2bool, default=True, help="apply class shape priors to each tile's output")
+parser.add_argument("-streaming_nms", type=str2bool, default=False, help="approximate NMS row by row, bounded memory")
+parser.add_argument("-skip_nodata", type=float, default=1.0, help="skip tiles with at least this no-data fraction")
+parser.add_argument("-skip_std", type=float, default=0.0, help="skip tiles with pixel std below this (homogeneous)")
+parser.add_argument("-coarse", type=int, default=0, help="find occupied tiles on the scene downscaled by this first")
+parser.add_argument("-coarse_thres", type=float, default=0.05, help="-coarse objectness threshold of occupied tiles")
+parser.add_argument("-tta", type=str2bool, default=False, help="add up-down and left-right flipped tiles to each batch")
 parser.add_argument("-cfg", type=str, default="cfg/c60_a30symmetric.cfg", help="cfg file path")
+parser.add_argument("-torchscript", type=str, default="", help="TorchScript detector from export.py, replaces -cfg")
+parser.add_argument("-formats", type=str, default="", help="extra result formats, comma-separated npz,parquet,geojson")
 parser.add_argument("-class_path", type=str, default="./xview.names", help="path to class label file")
+parser.add_argument("-classes", type=str, default="", help="comma-separated class indices or names to detect, or all")
 parser.add_argument("-conf_thres", type=float, default=0.99, help="object confidence threshold")
 parser.add_argument("-nms_thres", type=float, default=0.4, help="iou threshold for non-maximum suppression")
-parser.add_argument("-batch_size", type=int, default=1, help="size of the batches")
+parser.add_argument("-batch_size", type=int, default=1, help="number of tiles per forward pass")
 parser.add_argument("-img_size", type=int, default=32 * 51, help="size of each image dimension")
+parser.add_argument("-overlap", type=int, default=0, help="minimum overlap in pixels between neighbouring tiles")
+parser.add_argument("-strip", type=str2bool, default=False, help="seam-free full-width strips, slower than tiles")
+parser.add_argument("-halo", type=int, default=-1, help="-strip context rows per side, -1 for half receptive field")
 opt = parser.parse_args()
 print(opt)
 
 
 def detect(opt):
     """Perform object detection on images using the specified model and configurations."""
+    reference = np.loadtxt(opt.reference, ndmin=2) if opt.reference else None  # read before outputs are cleared
     if opt.plot_flag:
         os.system(f"rm -rf {opt.output_folder}_img")
         os.makedirs(f"{opt.output_folder}_img", exist_ok=True)
     os.system(f"rm -rf {opt.output_folder}")
     os.makedirs(opt.output_folder, exist_ok=True)
     device = torch.device("cuda:0" if cuda else "cpu")
+    classes = load_classes(opt.class_path)  # Extracts class labels from file
+    keep = parse_classes(opt.classes, classes)  # classes to report, the model scores all classes
+    keep = keep if len(keep) < len(classes) else None
+    formats = parse_formats(opt.formats)  # extra result files
 
     # Load model 1
-    model = Darknet(opt.cfg, opt.img_size)
-    checkpoint = torch.load("checkpoints/best.pt", map_location="cpu")
+    if opt.torchscript:
+        config = {"config.json": ""}
+        model = torch.jit.load(opt.torchscript, map_location=device, _extra_files=config)
+        config = json.loads(config["config.json"])
+        assert config["img_size"] == opt.img_size, f"{opt.torchscript} was exported for -img_size {config['img_size']}"
+        assert config["conf_thres"] <= opt.conf_thres, (
+            f"{opt.torchscript} was exported for -conf_thres >= {config['conf_thres']}"
+        )
+        normalize = not config["fold_normalization"]
+        assert "classes" not in config, f"{opt.torchscript} has pruned class channels, re-export it without -classes"
+    else:
+        model = Darknet(opt.cfg, opt.img_size)
+        checkpoint = torch.load("checkpoints/best.pt", map_location="cpu")
+
+        model.load_state_dict(checkpoint["model"])
+        model.to(device).eval()
+        model.conf_thres = opt.conf_thres  # decode only cells above threshold
+        del checkpoint
 
-    model.load_state_dict(checkpoint["model"])
-    model.to(device).eval()
-    del checkpoint
+        normalize = not opt.fold_normalization
+        if opt.fold_normalization:
+            model.fold_normalization(RGB_MEAN, RGB_STD)  # model is fed raw RGB tiles
+        if opt.fuse:
+            tile = torch.zeros(1, 3, opt.img_size, opt.img_size, device=device)
+            t = time_forward(model, tile) if opt.benchmark else 0
+            model.fuse()
+            if opt.benchmark:
+                tf = time_forward(model, tile)
+                print(f"Conv+BN fusion: {t:.3f}s -> {tf:.3f}s per tile ({t / tf:.2f}x)")
 
     # current = model.state_dict()
     # saved = checkpoint['model']
@@ -78,147 +140,191 @@ def detect(opt):
         model2.load_state_dict(checkpoint["model"])
         model2.to(device).eval()
         del checkpoint
+
+        chips = torch.zeros(256, 3, 64, 64, device=device)
+        t = time_forward(model2, chips) if opt.benchmark else 0
+        if opt.fuse:
+            model2.fuse(opt.channels_last)
+        if opt.script_classifier:
+            with torch.no_grad():
+                model2 = torch.jit.freeze(torch.jit.trace(model2, chips, check_trace=False))
+        if opt.benchmark:
+            tf = time_forward(model2, chips)
+            print(f"secondary classifier: {t:.3f}s -> {tf:.3f}s per {len(chips):g} chips ({t / tf:.2f}x)")
     else:
         model2 = None
 
     # Set Dataloader
-    classes = load_classes(opt.class_path)  # Extracts class labels from file
-    dataloader = ImageFolder(opt.image_folder, batch_size=opt.batch_size, img_size=opt.img_size)
+    dataloader = ImageFolder(opt.image_folder, img_size=opt.img_size, normalize=normalize)
+    if opt.quantize and opt.torchscript:
+        print(f"WARNING: -quantize ignored, {opt.torchscript} runs as exported (fp32)")
+    elif opt.quantize:
+        assert device.type == "cpu", "-quantize is CPU only"
+        calibration, rng = [], np.random.RandomState(0)
+        per_scene = math.ceil(opt.calibration_tiles / dataloader.nF)
+        for _, img in dataloader:  # a few random tiles from each scene, no-data and featureless tiles skipped
+            n = min(per_scene, opt.calibration_tiles - len(calibration))
+            for _ in range(10 * n):  # bounded, scenes may be mostly no-data
+                y1 = rng.randint(max(img.shape[1] - opt.img_size, 0) + 1)
+                x1 = rng.randint(max(img.shape[2] - opt.img_size, 0) + 1)
+                window = y1, y1 + opt.img_size, x1, x1 + opt.img_size
+                nodata, std = img.stats(*window)
+                if nodata >= opt.skip_nodata or std < opt.skip_std:
+                    continue
+                calibration.append(torch.from_numpy(img.window(*window)).unsqueeze(0))
+                n -= 1
+                if n == 0:
+                    break
+            if len(calibration) == opt.calibration_tiles:
+                break
+        assert calibration, "-quantize found no calibration tiles with image data"
+
+        tile = torch.zeros(1, 3, opt.img_size, opt.img_size)
+        t = time_forward(model, tile) if opt.benchmark else 0
+        model.quantize(calibration)
+        if opt.benchmark:
+            tq = time_forward(model, tile)
+            print(f"int8 quantization: {t:.3f}s -> {tq:.3f}s per tile ({t / tq:.2f}x)")
+        del calibration
 
     imgs = []  # Stores image paths
     img_detections = []  # Stores detections for each image index
+    colors = np.random.randint(0, 256, size=(len(classes), 3)).astype(np.uint8)  # Bounding-box colors
+    renderer = ThreadPoolExecutor(max_workers=1) if opt.plot_flag else None  # plots off the critical path
+    renders = []
     prev_time = time.time()
     detections = None
     mat_priors = scipy.io.loadmat(targets_path)
+    bounds = prior_bounds(mat_priors)
+    halo = opt.halo if opt.halo >= 0 else receptive_field(parse_model_config(opt.cfg)[1:]) / 2
+    halo = math.ceil(halo / 32) * 32  # stride aligned
     for batch_i, (img_paths, img) in enumerate(dataloader):
         print("\n", batch_i, img.shape, end=" ")
 
-        # img_ud = np.ascontiguousarray(np.flip(img, axis=1))
-        # img_lr = np.ascontiguousarray(np.flip(img, axis=2))
-
         preds = []
-        length = opt.img_size
-        ni = math.ceil(img.shape[1] / length)  # up-down
-        nj = math.ceil(img.shape[2] / length)  # left-right
-        for i in range(ni):  # for i in range(ni - 1):
-            print(f"row {i:g}/{ni:g}: ", end="")
-
-            for j in range(nj):  # for j in range(nj if i==0 else nj - 1):
-                print(f"{j:g} ", end="", flush=True)
-
-                # forward scan
-                y2 = min((i + 1) * length, img.shape[1])
-                y1 = y2 - length
-                x2 = min((j + 1) * length, img.shape[2])
-                x1 = x2 - length
-
-                # Get detections
-                with torch.no_grad():
-                    # Normal orientation
-                    chip = torch.from_numpy(img[:, y1:y2, x1:x2]).unsqueeze(0).to(device)
-                    pred = model(chip)
-                    pred = pred[pred[:, :, 4] > opt.conf_thres]
-                    # if (j > 0) & (len(pred) > 0):
-                    #     pred = pred[(pred[:, 0] - pred[:, 2] / 2 > 2)]  # near left border
-                    # if (j < nj) & (len(pred) > 0):
-                    #     pred = pred[(pred[:, 0] + pred[:, 2] / 2 < 606)]  # near right border
-                    # if (i > 0) & (len(pred) > 0):
-                    #     pred = pred[(pred[:, 1] - pred[:, 3] / 2 > 2)]  # near top border
-                    # if (i < ni) & (len(pred) > 0):
-                    #     pred = pred[(pred[:, 1] + pred[:, 3] / 2 < 606)]  # near bottom border
-                    if len(pred) > 0:
-                        pred[:, 0] += x1
-                        pred[:, 1] += y1
-                        preds.append(pred.unsqueeze(0))
-
-                    # # Flipped Up-Down
-                    # chip = torch.from_numpy(img_ud[:, y1:y2, x1:x2]).unsqueeze(0).to(device)
-                    # pred = model(chip)
-                    # pred = pred[pred[:, :, 4] > opt.conf_thres]
-                    # if len(pred) > 0:
-                    #     pred[:, 0] += x1
-                    #     pred[:, 1] = img.shape[1] - (pred[:, 1] + y1)
-                    #     preds.append(pred.unsqueeze(0))
-
-                    # # Flipped Left-Right
-                    # chip = torch.from_numpy(img_lr[:, y1:y2, x1:x2]).unsqueeze(0).to(device)
-                    # pred = model(chip)
-                    # pred = pred[pred[:, :, 4] > opt.conf_thres]
-                    # if len(pred) > 0:
-                    #     pred[:, 0] = img.shape[2] - (pred[:, 0] + x1)
-                    #     pred[:, 1] += y1
-                    #     preds.append(pred.unsqueeze(0))
-
-        if preds:
+        ambiguity = opt.secondary_conf, opt.secondary_margin
+        stats = {"chips": 0, "gated": 0, "time": 0.0}  # secondary classifier use
+        stream = (
+            StreamingNMS(opt.conf_thres, opt.nms_thres, mat_priors, img, model2, device, None, ambiguity, stats, keep)
+            if opt.streaming_nms
+            else None
+        )
+        if opt.strip:
+            windows = plan_strips(img.shape[1], img.shape[2], opt.img_size, halo)  # (window, core) forward scan
+        else:
+            windows = plan_tiles(img.shape[1], img.shape[2], opt.img_size, opt.overlap)
+        nodata, std = np.array([img.stats(*window) for window, _ in windows]).reshape(-1, 2).T
+        skip = (nodata >= opt.skip_nodata) | (std < opt.skip_std)  # empty or featureless, nothing to detect
+        n_skip = int(skip.sum())
+        windows = [tile for tile, s in zip(windows, skip) if not s]
+        if opt.coarse > 1:  # full resolution scan of occupied tiles only
+            t = time.time()
+            xy = coarse_centers(model, img, opt, device)
+            occupied = occupied_tiles(windows, xy, margin=32 * opt.coarse)  # one coarse stride-32 cell
+            print(
+                f"coarse pass: {len(xy):g} objects in {occupied.sum():g}/{len(windows):g} tiles "
+                f"({time.time() - t:.3f}s)",
+                end=" ",
+            )
+            n_skip += len(windows) - int(occupied.sum())
+            windows = [tile for tile, o in zip(windows, occupied) if o]
+
+        # Gather opt.batch_size tiles per forward pass, then scatter predictions back to scene coordinates
+        t_forward = 0.0
+        for k in range(0, len(windows), opt.batch_size):
+            batch = windows[k : k + opt.batch_size]
+            print(f"{k + len(batch):g}/{len(windows):g} ", end="", flush=True)
+
+            with torch.no_grad():
+                chips = np.stack([img.window(*window) for window, _ in batch])
+                if opt.tta:  # flipped views of the same tiles, one forward pass
+                    chips = np.concatenate((chips, chips[:, :, ::-1], chips[:, :, :, ::-1]))
+                t = time.time()
+                pred = model(torch.from_numpy(np.ascontiguousarray(chips)).to(device))
+                t_forward += time.time() - t
+
+            if opt.tta:  # un-flip predictions onto their source tiles, non_max_suppression() merges the views
+                view = torch.div(pred[:, 0], len(batch), rounding_mode="floor")
+                pred[:, 0] -= view * len(batch)
+                pred[view == 1, 2] = chips.shape[2] - pred[view == 1, 2]
+                pred[view == 2, 1] = chips.shape[3] - pred[view == 2, 1]
+
+            for b, ((y1, _, x1, _), (cy1, cy2, cx1, cx2)) in enumerate(batch):
+                p = pred[pred[:, 0] == b, 1:]  # sparse decode rows are (image_index, x, y, w, h, conf, classes)
+                p = p[p[:, 4] > opt.conf_thres]  # TorchScript models may be exported at a lower threshold
+                if opt.tile_priors:
+                    p = tile_prior_filter(p, bounds, classify=model2 is None)
+                p[:, 0] += x1
+                p[:, 1] += y1
+                p = p[(p[:, 0] >= cx1) & (p[:, 0] < cx2) & (p[:, 1] >= cy1) & (p[:, 1] < cy2)]  # centered in core
+                if len(p) > 0:
+                    if stream is not None:
+                        stream.add(p)
+                    else:
+                        preds.append(p.unsqueeze(0))
+
+            if stream is not None and k + opt.batch_size < len(windows):
+                stream.flush(windows[k + opt.batch_size][0][0])  # remaining windows start at or below this row
+
+        scene = len(imgs)
+        if stream is not None:
+            img_detections.append(stream.result())
+            imgs.extend(img_paths)
+        elif preds:
+            preds = torch.cat(preds, 1)
             detections = non_max_suppression(
-                torch.cat(preds, 1), opt.conf_thres, opt.nms_thres, mat_priors, img, model2, device
+                preds, opt.conf_thres, opt.nms_thres, mat_priors, img, model2, device, ambiguity, stats, keep
             )
             img_detections.extend(detections)
             imgs.extend(img_paths)
 
-        print(f"Batch {batch_i:d}... (Done {time.time() - prev_time:.3f}s)")
+        # Plot detections in the background while the next scene runs
+        for path, detections in zip(imgs[scene:], img_detections[scene:]):
+            if renderer is not None and detections is not None:
+                results_img_path = os.path.join(f"{opt.output_folder}_img", path.split("/")[-1])
+                results_img_path = results_img_path.replace(".bmp", ".jpg").replace(".tif", ".jpg")
+                args = detections.cpu().numpy(), classes, colors, results_img_path, opt.plot_scale, opt.plot_pyramid
+                renders.append(renderer.submit(render_detections, path, *args))
+
+        print(
+            f"Batch {batch_i:d}... (Done {time.time() - prev_time:.3f}s, "
+            f"{t_forward / max(len(windows), 1):.3f}s/tile forward)"
+        )
+        if n_skip:
+            print(f"{n_skip:g} empty tiles skipped, ~{n_skip * t_forward / max(len(windows), 1):.1f}s forward saved")
+        if model2 is not None:
+            n = stats["chips"]
+            saved = f", ~{stats['gated'] * stats['time'] / n:.1f}s saved" if n else ""  # no per chip time to scale
+            print(f"secondary classifier: {n:g} chips classified, {stats['gated']:g} certain gated{saved}")
         prev_time = time.time()
 
-    # Bounding-box colors
-    color_list = [[random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)] for _ in range(len(classes))]
-
     if not img_detections:
         return
 
-    # Iterate through images and save plot of detections
+    # Iterate through images and save detections
     for img_i, (path, detections) in enumerate(zip(imgs, img_detections)):
         print(f"image {img_i:g}: '{path}'")
 
-        if opt.plot_flag:
-            img = cv2.imread(path)
-
-        # # The amount of padding that was added
-        # pad_x = max(img.shape[0] - img.shape[1], 0) * (opt.img_size / max(img.shape))
-        # pad_y = max(img.shape[1] - img.shape[0], 0) * (opt.img_size / max(img.shape))
-        # # Image height and width after padding is removed
-        # unpad_h = opt.img_size - pad_y
-        # unpad_w = opt.img_size - pad_x
-
-        # Draw bounding boxes and labels of detections
         if detections is not None:
-            unique_classes = detections[:, -1].cpu().unique()
-            bbox_colors = random.sample(color_list, len(unique_classes))
+            for i in detections[:, -1].cpu().unique():
+                n = (detections[:, -1].cpu() == i).sum()
+                print(f"{n:g} {classes[int(i)]}s")
 
             # write results to .txt file
-            results_path = os.path.join(opt.output_folder, path.split("/")[-1])
-            if os.path.isfile(f"{results_path}.txt"):
-                os.remove(f"{results_path}.txt")
-
-            results_img_path = os.path.join(f"{opt.output_folder}_img", path.split("/")[-1])
-            with open(results_path.replace(".bmp", ".tif") + ".txt", "a") as file:
-                for i in unique_classes:
-                    n = (detections[:, -1].cpu() == i).sum()
-                    print(f"{n:g} {classes[int(i)]}s")
-
-                for x1, y1, x2, y2, conf, cls_conf, cls_pred in detections:
-                    # Rescale coordinates to original dimensions
-                    # box_h = ((y2 - y1) / unpad_h) * img.shape[0]
-                    # box_w = ((x2 - x1) / unpad_w) * img.shape[1]
-                    # y1 = (((y1 - pad_y // 2) / unpad_h) * img.shape[0]).round().item()
-                    # x1 = (((x1 - pad_x // 2) / unpad_w) * img.shape[1]).round().item()
-                    # x2 = (x1 + box_w).round().item()
-                    # y2 = (y1 + box_h).round().item()
-                    x1, y1, x2, y2 = max(x1, 0), max(y1, 0), max(x2, 0), max(y2, 0)
-
-                    # write to file
-                    xvc = xview_indices2classes(int(cls_pred))  # xview class
-                    # if (xvc != 21) & (xvc != 72):
-                    file.write(f"{x1:g} {y1:g} {x2:g} {y2:g} {xvc:g} {cls_conf * conf:g} \n")
-
-                    if opt.plot_flag:
-                        # Add the bbox to the plot
-                        label = f"{classes[int(cls_pred)]} {cls_conf:.2f}" if cls_conf > 0.05 else None
-                        color = bbox_colors[int(np.where(unique_classes == int(cls_pred))[0])]
-                        plot_one_box([x1, y1, x2, y2], img, label=label, color=color, line_thickness=1)
-
-            if opt.plot_flag:
-                # Save generated image with detections
-                cv2.imwrite(results_img_path.replace(".bmp", ".jpg").replace(".tif", ".jpg"), img)
+            results_path = os.path.join(opt.output_folder, path.split("/")[-1]).replace(".bmp", ".tif")
+            write_detections(results_path, detections, formats)
+
+            results_txt = results_path + ".txt"
+            if reference is not None and os.path.basename(opt.reference) == os.path.basename(results_txt):
+                results = np.loadtxt(results_txt, ndmin=2)
+                n, dconf = compare_detections(reference, results)
+                print(
+                    f"{opt.reference}: {len(reference):g} reference vs {len(results):g} detections, {n:g} matched "
+                    f"(one to one, same class, IoU > 0.5), mean |conf delta| {dconf:.4f}"
+                )
+
+    for render in renders:
+        render.result()  # wait for plots, raising any plotting error
 
     if opt.plot_flag:
         from scoring import score
@@ -230,6 +336,36 @@ def detect(opt):
         )
 
 
+def coarse_centers(model, img, opt, device):
+    """Returns (n, 2) scene xy centers of objects with objectness above opt.coarse_thres, found by one detector pass
+    over the scene downscaled by opt.coarse. TorchScript models only decode above their exported conf_thres.
+    """
+    small = img.downscale(opt.coarse)
+    scale = np.array([img.shape[2] / small.shape[2], img.shape[1] / small.shape[1]], dtype=np.float32)
+    conf_thres = getattr(model, "conf_thres", None)
+    if isinstance(model, Darknet):
+        model.conf_thres = opt.coarse_thres  # sparse decode at the low threshold
+
+    xy = [np.zeros((0, 2), dtype=np.float32)]
+    size = opt.img_size
+    if isinstance(model, Darknet):  # any stride multiple, pad small scenes only to the stride (TorchScript is fixed)
+        size = tuple(min(opt.img_size, math.ceil(n / 32) * 32) for n in small.shape[1:])
+    tiles = plan_tiles(small.shape[1], small.shape[2], size)
+    for k in range(0, len(tiles), opt.batch_size):
+        batch = tiles[k : k + opt.batch_size]
+        with torch.no_grad():
+            chips = np.stack([small.window(*window) for window, _ in batch])
+            pred = model(torch.from_numpy(chips).to(device)).cpu()
+        for b, ((y1, _, x1, _), (cy1, cy2, cx1, cx2)) in enumerate(batch):
+            p = pred[pred[:, 0] == b, 1:]
+            p = p[p[:, 4] > opt.coarse_thres, :2].numpy() + (x1, y1)
+            xy.append(p[(p[:, 0] >= cx1) & (p[:, 0] < cx2) & (p[:, 1] >= cy1) & (p[:, 1] < cy2)] * scale)
+
+    if isinstance(model, Darknet):
+        model.conf_thres = conf_thres
+    return np.concatenate(xy)
+
+
 class ConvNetb(nn.Module):
     """A convolutional neural network for image classification with multiple layers and configurable output classes."""
 
@@ -265,9 +401,23 @@ class ConvNetb(nn.Module):
 
         # self.fc = nn.Linear(int(8192), num_classes)  # 64 pixels, 4 layer, 64 filters
         self.fully_convolutional = nn.Conv2d(n * 16, 60, kernel_size=4, stride=1, padding=0, bias=True)
+        self.channels_last = False  # input memory format, see fuse()
+
+    def fuse(self, channels_last=True):
+        """Fold each BatchNorm2d into its preceding Conv2d for inference, optionally in channels-last memory format."""
+        for name in ("layer1", "layer2", "layer3", "layer4", "layer5"):
+            layer = getattr(self, name)
+            if isinstance(layer[1], nn.BatchNorm2d):  # not yet fused
+                conv, bn, act = layer
+                setattr(self, name, nn.Sequential(fuse_conv_and_bn(conv, bn), act))
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+        self.channels_last = channels_last
 
     def forward(self, x):  # 500 x 1 x 64 x 64
         """Performs the forward pass by sequentially applying model layers to input tensor x."""
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         x = self.layer1(x)
         x = self.layer2(x)
         x = self.layer3(x)
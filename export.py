@@ -0,0 +1,53 @@
+# Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
+
+import argparse
+import json
+import time
+
+import torch
+
+from models import Darknet
+from utils.datasets import RGB_MEAN, RGB_STD
+from utils.utils import str2bool
+
+parser = argparse.ArgumentParser()
+# python3 export.py -output checkpoints/best.torchscript.pt
+parser.add_argument("-cfg", type=str, default="cfg/c60_a30symmetric.cfg", help="cfg file path")
+parser.add_argument("-weights", type=str, default="checkpoints/best.pt", help="checkpoint to export")
+parser.add_argument("-output", type=str, default="checkpoints/best.torchscript.pt", help="exported detector path")
+parser.add_argument("-conf_thres", type=float, default=0.99, help="lowest object confidence threshold for detect.py")
+parser.add_argument("-batch_size", type=int, default=1, help="number of tiles per forward pass")
+parser.add_argument("-img_size", type=int, default=32 * 51, help="size of each image dimension")
+parser.add_argument("-fold_normalization", type=str2bool, default=True, help="absorb RGB mean/std into the first conv")
+opt = parser.parse_args()
+print(opt)
+
+
+def export(opt):
+    """Export the fused Darknet detector, including the YOLOLayer sparse decode, as a frozen TorchScript module."""
+    t = time.time()
+    model = Darknet(opt.cfg, opt.img_size)
+    model.load_state_dict(torch.load(opt.weights, map_location="cpu")["model"])
+    model.eval()
+    if opt.fold_normalization:
+        model.fold_normalization(RGB_MEAN, RGB_STD)
+    model.fuse()
+    model.conf_thres = opt.conf_thres
+
+    # Trace at the tile size detect.py runs, the decode grids of that size become constants
+    img = torch.zeros(opt.batch_size, 3, opt.img_size, opt.img_size)
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, img, check_trace=False))
+
+    config = {
+        "cfg": opt.cfg,
+        "img_size": opt.img_size,
+        "conf_thres": opt.conf_thres,
+        "fold_normalization": bool(opt.fold_normalization),
+    }
+    torch.jit.save(traced, opt.output, _extra_files={"config.json": json.dumps(config)})
+    print(f"Exported {opt.weights} to {opt.output} ({time.time() - t:.3f}s)")
+
+
+if __name__ == "__main__":
+    export(opt)
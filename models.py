@@ -1,12 +1,17 @@
 # Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
 
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from torch import nn
 
-from utils.utils import build_targets
+from utils.utils import build_targets, fuse_conv_and_bn
+
+# Execution plan opcodes, see compile_plan()
+CONV, UPSAMPLE, ROUTE, SHORTCUT, YOLO = range(5)
+OPCODES = {"convolutional": CONV, "upsample": UPSAMPLE, "route": ROUTE, "shortcut": SHORTCUT, "yolo": YOLO}
 
 
 def create_modules(module_defs):
@@ -80,6 +85,29 @@ class EmptyLayer(nn.Module):
         super().__init__()
 
 
+class ChannelPad2d(nn.Module):
+    """Pads each channel with its own constant, i.e. the RGB mean absorbed by Darknet.fold_normalization()."""
+
+    def __init__(self, padding, value):
+        """Initializes with (pad_h, pad_w) padding and a per-channel pad value."""
+        super().__init__()
+        self.padding = padding
+        self.register_buffer("value", torch.FloatTensor(value).view(1, -1, 1, 1))
+
+    def forward(self, x):
+        """Zero-pads x, then fills the border with the per-channel value."""
+        ph, pw = self.padding
+        x = F.pad(x, [pw, pw, ph, ph])
+        v = self.value.to(x.dtype)
+        if ph:
+            x[:, :, :ph] = v.expand_as(x[:, :, :ph])  # expand_as keeps the batch size dynamic under torch.jit.trace
+            x[:, :, -ph:] = v.expand_as(x[:, :, -ph:])
+        if pw:
+            x[:, :, :, :pw] = v.expand_as(x[:, :, :, :pw])
+            x[:, :, :, -pw:] = v.expand_as(x[:, :, :, -pw:])
+        return x
+
+
 class YOLOLayer(nn.Module):
     """YOLOLayer implements the YOLO detection layer for handling anchor boxes and class predictions."""
 
@@ -103,42 +131,42 @@ class YOLOLayer(nn.Module):
         else:
             stride = 8
 
-        # Build anchor grids
-        nG = int(self.img_dim / stride)
-        self.grid_x = torch.arange(nG).repeat(nG, 1).view([1, 1, nG, nG]).float()
-        self.grid_y = torch.arange(nG).repeat(nG, 1).t().view([1, 1, nG, nG]).float()
+        # Anchor grids are built lazily per grid size, device and dtype, see get_grids()
+        self.stride = stride
         self.scaled_anchors = torch.FloatTensor([(a_w / stride, a_h / stride) for a_w, a_h in anchors])
-        self.anchor_w = self.scaled_anchors[:, 0:1].view((1, nA, 1, 1))
-        self.anchor_h = self.scaled_anchors[:, 1:2].view((1, nA, 1, 1))
+        self.grids = OrderedDict()  # least recently used first
+        self.max_grids = 8
 
     # @profile
-    def forward(self, p, targets=None, requestPrecision=False, weight=None, epoch=None):
+    def forward(self, p, targets=None, requestPrecision=False, weight=None, epoch=None, conf_thres=None):
         """Performs a forward pass in the model with given input tensors, target data, precision flag, weights, and
         epoch info.
+
+        In inference mode with conf_thres set, only cells whose objectness exceeds conf_thres are decoded, returning a
+        compact (n, 6 + nC) tensor of (image_index, x, y, w, h, conf, class logits) rows.
         """
         FT = torch.cuda.FloatTensor if p.is_cuda else torch.FloatTensor
         torch.device("cuda:0" if p.is_cuda else "cpu")
         # weight = xview_class_weights(range(60)).to(device)
 
         bs = p.shape[0]
-        nG = p.shape[2]
-        stride = self.img_dim / nG
+        nG, nGx = p.shape[2], p.shape[3]  # grid height and width, rectangular tiles allowed in inference
+        stride = self.stride
 
-        if p.is_cuda and not self.grid_x.is_cuda:
-            self.grid_x, self.grid_y = self.grid_x.cuda(), self.grid_y.cuda()
-            self.anchor_w, self.anchor_h = self.anchor_w.cuda(), self.anchor_h.cuda()
-            # self.scaled_anchors = self.scaled_anchors.cuda()
+        if targets is None and conf_thres is not None:
+            return self.sparse_decode(p, conf_thres)
+        grid_x, grid_y, anchor_w, anchor_h, _ = self.get_grids(nG, nGx, p.device, p.dtype)
 
         # x.view(4, 650, 19, 19) -- > (4, 10, 19, 19, 65)  # (bs, anchors, grid, grid, classes + xywh)
-        p = p.view(bs, self.nA, self.bbox_attrs, nG, nG).permute(0, 1, 3, 4, 2).contiguous()  # prediction
+        p = p.view(bs, self.nA, self.bbox_attrs, nG, nGx).permute(0, 1, 3, 4, 2).contiguous()  # prediction
 
         # Get outputs
         x = torch.sigmoid(p[..., 0])  # Center x
         y = torch.sigmoid(p[..., 1])  # Center y
         w = torch.sigmoid(p[..., 2])  # Width
         h = torch.sigmoid(p[..., 3])  # Height
-        width = ((w.data * 2) ** 2) * self.anchor_w
-        height = ((h.data * 2) ** 2) * self.anchor_h
+        width = ((w.data * 2) ** 2) * anchor_w
+        height = ((h.data * 2) ** 2) * anchor_h
 
         # Add offset and scale with anchors (in grid space, i.e. 0-13)
         pred_boxes = FT(p[..., :4].shape)
@@ -154,12 +182,10 @@ class YOLOLayer(nn.Module):
             CrossEntropyLoss = nn.CrossEntropyLoss(weight=weight)
 
             if requestPrecision:
-                gx = self.grid_x[:, :, :nG, :nG]
-                gy = self.grid_y[:, :, :nG, :nG]
-                pred_boxes[..., 0] = x.data + gx - width / 2
-                pred_boxes[..., 1] = y.data + gy - height / 2
-                pred_boxes[..., 2] = x.data + gx + width / 2
-                pred_boxes[..., 3] = y.data + gy + height / 2
+                pred_boxes[..., 0] = x.data + grid_x - width / 2
+                pred_boxes[..., 1] = y.data + grid_y - height / 2
+                pred_boxes[..., 2] = x.data + grid_x + width / 2
+                pred_boxes[..., 3] = y.data + grid_y + height / 2
 
             tx, ty, tw, th, mask, tcls, TP, FP, FN, TC = build_targets(
                 pred_boxes, pred_conf, pred_cls, targets, self.scaled_anchors, self.nA, self.nC, nG, requestPrecision
@@ -213,8 +239,8 @@ class YOLOLayer(nn.Module):
             )
 
         else:
-            pred_boxes[..., 0] = x.data + self.grid_x
-            pred_boxes[..., 1] = y.data + self.grid_y
+            pred_boxes[..., 0] = x.data + grid_x
+            pred_boxes[..., 1] = y.data + grid_y
             pred_boxes[..., 2] = width
             pred_boxes[..., 3] = height
 
@@ -229,6 +255,40 @@ class YOLOLayer(nn.Module):
             )
             return output.data
 
+    def get_grids(self, ny, nx, device, dtype=torch.float32):
+        """Returns cached (grid_x, grid_y, anchor_w, anchor_h, anchor_wh) decode tensors for an ny x nx grid on device,
+        building them on first use and evicting the least recently used entry beyond max_grids.
+        """
+        key = (ny, nx, str(device), dtype)
+        grids = self.grids.pop(key, None)
+        if grids is None:
+            anchor_wh = self.scaled_anchors.to(device=device, dtype=dtype)
+            grids = (
+                torch.arange(nx, device=device, dtype=dtype).view(1, 1, 1, nx),
+                torch.arange(ny, device=device, dtype=dtype).view(1, 1, ny, 1),
+                anchor_wh[:, 0].view(1, self.nA, 1, 1),
+                anchor_wh[:, 1].view(1, self.nA, 1, 1),
+                anchor_wh,
+            )
+            if len(self.grids) >= self.max_grids:
+                self.grids.popitem(last=False)
+        self.grids[key] = grids
+        return grids
+
+    def sparse_decode(self, p, conf_thres):
+        """Decodes only the anchor cells whose objectness sigmoid exceeds conf_thres, skipping the dense output."""
+        ny, nx = p.shape[2], p.shape[3]
+        p = p.view(-1, self.nA, self.bbox_attrs, ny, nx)  # no permute, gather cells directly
+
+        conf = torch.sigmoid(p[:, :, 4])  # (bs, anchors, grid, grid)
+        b, a, gj, gi = (conf > conf_thres).nonzero().unbind(1)
+        pc = p[b, a, :, gj, gi]  # (n, bbox_attrs)
+
+        anchor_wh = self.get_grids(ny, nx, p.device, p.dtype)[4][a]
+        xy = (torch.sigmoid(pc[:, 0:2]) + torch.stack((gi, gj), 1).to(p.dtype)) * self.stride
+        wh = ((torch.sigmoid(pc[:, 2:4]) * 2) ** 2) * anchor_wh * self.stride
+        return torch.cat((b.float().unsqueeze(1), xy, wh, conf[b, a, gj, gi].unsqueeze(1), pc[:, 5:]), 1)
+
 
 class Darknet(nn.Module):
     """YOLOv3 object detection model."""
@@ -240,8 +300,64 @@ class Darknet(nn.Module):
         self.module_defs[0]["height"] = img_size
         self.hyperparams, self.module_list = create_modules(self.module_defs)
         self.img_size = img_size
+        self.conf_thres = None  # inference-only objectness gate, enables YOLOLayer sparse decode when set
+        self.plan = compile_plan(self.module_defs)
         self.loss_names = ["loss", "x", "y", "w", "h", "conf", "cls", "nGT", "TP", "FP", "FPe", "FN", "TC"]
 
+    def fold_normalization(self, rgb_mean, rgb_std):
+        """Absorb input normalization (x - rgb_mean) / rgb_std into the first convolution so raw RGB float tiles can be
+        fed directly. Zero padding becomes mean padding, keeping tile borders exact.
+        """
+        conv = self.module_list[0][0]
+        w = conv.weight.data
+        mean = torch.FloatTensor(np.ravel(rgb_mean)).to(w.device).view(1, -1, 1, 1)
+        std = torch.FloatTensor(np.ravel(rgb_std)).to(w.device).view(1, -1, 1, 1)
+
+        w = w / std
+        b = -(w * mean).sum((1, 2, 3))
+        if conv.bias is not None:
+            b += conv.bias.data
+        conv.weight.data = w
+        conv.bias = nn.Parameter(b)
+
+        if any(conv.padding):
+            pad = ChannelPad2d(conv.padding, mean.view(-1).tolist()).to(w.device)
+            conv.padding = (0, 0)
+            self.module_list[0] = nn.Sequential(OrderedDict([("pad_0", pad), *self.module_list[0].named_children()]))
+
+    def fuse(self):
+        """Fold each BatchNorm2d into its preceding Conv2d for inference, leaving Conv2d -> LeakyReLU blocks."""
+        for i, modules in enumerate(self.module_list):
+            children = OrderedDict(modules.named_children())
+            if f"batch_norm_{i:d}" in children:  # not yet fused
+                bn = children.pop(f"batch_norm_{i:d}")
+                children[f"conv_{i:d}"] = fuse_conv_and_bn(children[f"conv_{i:d}"], bn)
+                self.module_list[i] = nn.Sequential(children)
+
+    def quantize(self, calibration, backend="fbgemm"):
+        """Convert the convolutional stack to int8 for CPU inference with eager-mode static quantization, calibrating
+        activation ranges on an iterable of input batches. Each conv block is quantized and dequantized at its own
+        boundaries, so route/shortcut/upsample/YOLO layers stay float, as do the convolutions feeding each YOLO head.
+        """
+        from torch import quantization as tq
+
+        self.fuse()
+        torch.backends.quantized.engine = backend
+        qconfig = tq.get_default_qconfig(backend)
+        for i, (op, *_) in enumerate(self.plan):
+            if op == CONV and self.plan[i + 1][0] != YOLO:
+                children = list(self.module_list[i].named_children())
+                k = [name for name, _ in children].index(f"conv_{i:d}")  # after any ChannelPad2d
+                children = children[:k] + [("quant", tq.QuantStub())] + children[k:] + [("dequant", tq.DeQuantStub())]
+                self.module_list[i] = nn.Sequential(OrderedDict(children))
+                self.module_list[i].qconfig = qconfig
+
+        tq.prepare(self, inplace=True)
+        with torch.no_grad():
+            for x in calibration:
+                self(x)
+        tq.convert(self, inplace=True)
+
     def forward(self, x, targets=None, requestPrecision=False, weight=None, epoch=None):
         """Perform a forward pass through the network, optionally computing loss and returning outputs, targets, and
         other metrics.
@@ -249,18 +365,20 @@ class Darknet(nn.Module):
         is_training = targets is not None
         output = []
         self.losses = defaultdict(float)
-        layer_outputs = []
+        layer_outputs = [None] * len(self.module_list)  # only outputs read later by route/shortcut are kept
 
-        for i, (module_def, module) in enumerate(zip(self.module_defs, self.module_list)):
-            if module_def["type"] in ["convolutional", "upsample"]:
+        for i, ((op, sources, keep, release), module) in enumerate(zip(self.plan, self.module_list)):
+            if op == CONV or op == UPSAMPLE:
                 x = module(x)
-            elif module_def["type"] == "route":
-                layer_i = [int(x) for x in module_def["layers"].split(",")]
-                x = torch.cat([layer_outputs[i] for i in layer_i], 1)
-            elif module_def["type"] == "shortcut":
-                layer_i = int(module_def["from"])
-                x = layer_outputs[-1] + layer_outputs[layer_i]
-            elif module_def["type"] == "yolo":
+            elif op == ROUTE:
+                x = (
+                    layer_outputs[sources[0]]
+                    if len(sources) == 1
+                    else torch.cat([layer_outputs[j] for j in sources], 1)
+                )
+            elif op == SHORTCUT:
+                x = x + layer_outputs[sources[0]]
+            elif op == YOLO:
                 # Train phase: get loss
                 if is_training:
                     x, *losses = module[0](x, targets, requestPrecision, weight, epoch)
@@ -268,9 +386,12 @@ class Darknet(nn.Module):
                         self.losses[name] += loss
                 # Test phase: Get detections
                 else:
-                    x = module(x)
+                    x = module[0](x, conf_thres=self.conf_thres)
                 output.append(x)
-            layer_outputs.append(x)
+            if keep:
+                layer_outputs[i] = x
+            for j in release:  # last reader of layer j, free it
+                layer_outputs[j] = None
 
         if is_training:
             self.losses["nGT"] /= 3
@@ -292,7 +413,55 @@ class Darknet(nn.Module):
             self.losses["TC"] = 0
             self.losses["metrics"] = metrics
 
-        return sum(output) if is_training else torch.cat(output, 1)
+        if is_training:
+            return sum(output)
+        return torch.cat(output, 0 if self.conf_thres is not None else 1)
+
+
+def compile_plan(module_defs):
+    """Compiles module_defs once into an execution plan of (opcode, source layers, keep output, layers to free) per
+    layer, with route/shortcut sources resolved to absolute indices. Only outputs read again by a route/shortcut are
+    kept, and each is freed by its last reader.
+    """
+    ops, sources, last_use = [], [], {}
+    for i, module_def in enumerate(module_defs):
+        ops.append(OPCODES[module_def["type"]])
+        if module_def["type"] == "route":
+            layer_i = [int(x) for x in module_def["layers"].split(",")]
+        elif module_def["type"] == "shortcut":
+            layer_i = [int(module_def["from"])]
+        else:
+            layer_i = []
+        sources.append(tuple(j if j >= 0 else i + j for j in layer_i))
+        for j in sources[-1]:
+            last_use[j] = i
+
+    release = [[] for _ in module_defs]
+    for j, i in last_use.items():
+        release[i].append(j)
+    return [(ops[i], sources[i], i in last_use, tuple(release[i])) for i in range(len(module_defs))]
+
+
+def receptive_field(module_defs):
+    """Returns the largest receptive field in pixels of any YOLO head input, following module_defs (without [net])
+    through convolution strides, upsampling and route/shortcut merges.
+    """
+    rf, jump = [], []  # per layer output receptive field and input pixels per output pixel
+    for i, module_def in enumerate(module_defs):
+        r, j = (rf[-1], jump[-1]) if i else (1, 1)
+        if module_def["type"] == "convolutional":
+            r, j = r + (int(module_def["size"]) - 1) * j, j * int(module_def["stride"])
+        elif module_def["type"] == "upsample":
+            j = j / int(module_def["stride"])
+        elif module_def["type"] in ("route", "shortcut"):
+            layers = module_def["layers"] if module_def["type"] == "route" else module_def["from"]
+            sources = [int(x) if int(x) >= 0 else i + int(x) for x in layers.split(",")]
+            if module_def["type"] == "shortcut":
+                sources.append(i - 1)
+            r, j = max(rf[x] for x in sources), jump[sources[0]]
+        rf.append(r)
+        jump.append(j)
+    return max(rf[i] for i, module_def in enumerate(module_defs) if module_def["type"] == "yolo")
 
 
 def parse_model_config(path):
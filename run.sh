@@ -18,4 +18,9 @@
 # time sudo docker run -it --memory=8g --cpus=1 ultralytics/xview:v30 bash -c './run.sh /1047.tif /tmp && cat /tmp/1047.tif.txt'
 # sudo docker push ultralytics/xview:v30
 
-python3 detect.py -image_folder $1 -output_folder $2
+# TorchScript detector from 'python3 export.py', if present
+if [ -f checkpoints/best.torchscript.pt ]; then
+  python3 detect.py -image_folder $1 -output_folder $2 -torchscript checkpoints/best.torchscript.pt
+else
+  python3 detect.py -image_folder $1 -output_folder $2
+fi
@@ -13,12 +13,21 @@ import torch
 # from torch.utils.data import Dataset
 from utils.utils import xview_class_weights, xyxy2xywh
 
+try:
+    import tifffile  # optional, memory-maps uncompressed GeoTIFFs instead of decoding the whole scene
+except ImportError:
+    tifffile = None
+
+# RGB normalization values of xView scenes
+RGB_MEAN = [60.134, 49.697, 40.746]
+RGB_STD = [29.99, 24.498, 22.046]
+
 
 class ImageFolder:  # for eval-only
     """Loads and iterates over images from a specified directory for evaluation purposes."""
 
-    def __init__(self, path, batch_size=1, img_size=416):
-        """Initialize image paths, batch size, and image size."""
+    def __init__(self, path, batch_size=1, img_size=416, normalize=True):
+        """Initialize image paths, batch size, image size, and whether tiles are RGB normalized."""
         if os.path.isdir(path):
             self.files = sorted(glob.glob(f"{path}/*.*"))
         elif os.path.isfile(path):
@@ -28,11 +37,12 @@ class ImageFolder:  # for eval-only
         self.nB = math.ceil(self.nF / batch_size)  # number of batches
         self.batch_size = batch_size
         self.height = img_size
+        self.normalize = normalize  # False when the model absorbs normalization, see Darknet.fold_normalization()
         assert self.nF > 0, f"No images found in path {path}"
 
         # RGB normalization values
-        self.rgb_mean = np.array([60.134, 49.697, 40.746], dtype=np.float32).reshape((3, 1, 1))
-        self.rgb_std = np.array([29.99, 24.498, 22.046], dtype=np.float32).reshape((3, 1, 1))
+        self.rgb_mean = np.array(RGB_MEAN, dtype=np.float32).reshape((3, 1, 1))
+        self.rgb_std = np.array(RGB_STD, dtype=np.float32).reshape((3, 1, 1))
 
     def __iter__(self):
         """Initialize and return the iterable object with a reset count."""
@@ -46,22 +56,135 @@ class ImageFolder:  # for eval-only
             raise StopIteration
         img_path = self.files[self.count]
 
-        # Add padding
-        img = cv2.imread(img_path)  # BGR
-
-        # Normalize RGB
-        img = img[:, :, ::-1].transpose(2, 0, 1)
-        img = np.ascontiguousarray(img, dtype=np.float32)
-        img -= self.rgb_mean
-        img /= self.rgb_std
-
-        return [img_path], img
+        # Keep the scene uint8, tiles are normalized on demand
+        return [img_path], LazyScene(load_scene(img_path), self.rgb_mean, self.rgb_std, self.normalize)
 
     def __len__(self):
         """Return the number of batches 'nB'."""
         return self.nB  # number of batches
 
 
+class LazyScene:  # for eval-only
+    """Holds a uint8 RGB scene and returns normalized float32 CHW windows on demand, bounding float32 memory by the
+    tile size rather than the scene size.
+    """
+
+    def __init__(self, img, rgb_mean, rgb_std, normalize=True):
+        """Initialize with an HWC RGB uint8 array (decoded or memory-mapped) and (3, 1, 1) RGB normalization values."""
+        self.img = img
+        self.shape = (img.shape[2], img.shape[0], img.shape[1])  # CHW, as the float32 scene it replaces
+        self.rgb_mean = rgb_mean
+        self.rgb_std = rgb_std
+        self.normalize = normalize
+
+    def window(self, y1, y2, x1, x2):
+        """Return the float32 CHW window img[y1:y2, x1:x2], RGB normalized if self.normalize. Pixels outside the scene
+        are filled with the RGB mean, i.e. zero after normalization.
+        """
+        h, w = self.img.shape[:2]
+        if y1 >= 0 and x1 >= 0 and y2 <= h and x2 <= w:
+            img = np.ascontiguousarray(self.img[y1:y2, x1:x2].transpose(2, 0, 1), dtype=np.float32)
+        else:
+            img = np.empty((3, y2 - y1, x2 - x1), dtype=np.float32)
+            img[:] = self.rgb_mean
+            y1c, y2c, x1c, x2c = max(y1, 0), min(y2, h), max(x1, 0), min(x2, w)
+            img[:, y1c - y1 : y2c - y1, x1c - x1 : x2c - x1] = self.img[y1c:y2c, x1c:x2c].transpose(2, 0, 1)
+        if self.normalize:
+            img -= self.rgb_mean
+            img /= self.rgb_std
+        return img
+
+    def stats(self, y1, y2, x1, x2, step=4):
+        """Return the no-data (all-zero pixel) fraction and pixel standard deviation of window img[y1:y2, x1:x2],
+        sampling every 'step' pixels inside the scene. Padding outside the scene is neither data nor no-data; a window
+        with no pixels inside the scene is all no-data.
+        """
+        h, w = self.img.shape[:2]
+        img = self.img[max(y1, 0) : min(y2, h) : step, max(x1, 0) : min(x2, w) : step]
+        valid = img.any(2)
+        nodata = float(1 - valid.mean()) if valid.size else 1.0
+        return nodata, float(img[valid].std()) if valid.any() else 0.0
+
+    def downscale(self, factor):
+        """Return the scene area-resized by 1 / factor as a LazyScene with the same normalization."""
+        h, w = self.img.shape[:2]
+        size = (max(round(w / factor), 1), max(round(h / factor), 1))
+        img = cv2.resize(np.ascontiguousarray(self.img), size, interpolation=cv2.INTER_AREA)
+        return LazyScene(img, self.rgb_mean, self.rgb_std, self.normalize)
+
+
+def tile_spans(length, size, overlap=0):
+    """Return evenly spaced starts of the fewest 'size' windows covering 'length' pixels with at least 'overlap'
+    pixels between neighbours, and the [lo, hi) core each window owns, split halfway across every overlap.
+    """
+    assert 0 <= overlap < size, f"overlap must be in [0, {size})"
+    if length <= size:
+        return [0], [(-math.inf, math.inf)]  # one window, padded past the scene edge
+    n = math.ceil((length - overlap) / (size - overlap))
+    starts = np.linspace(0, length - size, n).round().astype(int)
+    cuts = ((starts[:-1] + size + starts[1:]) / 2).tolist()  # overlap midpoints
+    return starts.tolist(), list(zip([-math.inf, *cuts], [*cuts, math.inf]))
+
+
+def plan_tiles(height, width, size, overlap=0):
+    """Return row-major ((y1, y2, x1, x2) window, (y1, y2, x1, x2) core) tiles of a height x width scene, where
+    detections are kept only by the tile whose core holds their center. 'size' is a side or a (height, width) pair.
+    """
+    sy, sx = size if isinstance(size, tuple) else (size, size)
+    ys, y_cores = tile_spans(height, sy, overlap)
+    xs, x_cores = tile_spans(width, sx, overlap)
+    return [
+        ((y, y + sy, x, x + sx), (*y_core, *x_core)) for y, y_core in zip(ys, y_cores) for x, x_core in zip(xs, x_cores)
+    ]
+
+
+def plan_strips(height, width, band, halo, stride=32):
+    """Return ((y1, y2, x1, x2) window, core) full-width strips of 'band' core rows with at least 'halo' rows of
+    context above and below, as plan_tiles(). Windows are stride aligned, so each sees the grid of a whole-scene pass.
+    A scene no taller than band + 2 * halo rows, stride rounded, runs as one window without halo padding.
+    """
+    assert band % stride == 0 and halo % stride == 0, f"band and halo must be multiples of {stride}"
+    size = min(band + 2 * halo, math.ceil(height / stride) * stride)
+    top = math.ceil(height / stride) * stride - size  # last window start that stays inside the scene
+    width = math.ceil(width / stride) * stride
+    n = math.ceil(height / band)
+    tiles = []
+    for k in range(n):
+        y1 = min(max(k * band - halo, 0), top)
+        lo, hi = k * band if k else -math.inf, (k + 1) * band if k < n - 1 else math.inf
+        if tiles and tiles[-1][0][0] == y1:  # same clamped window, extend its core instead
+            lo = tiles.pop()[1][0]
+        tiles.append(((y1, y1 + size, 0, width), (lo, hi, -math.inf, math.inf)))
+    return tiles
+
+
+def occupied_tiles(tiles, xy, margin=0):
+    """Return a boolean mask of ((y1, y2, x1, x2) window, core) tiles whose core, grown by 'margin' pixels on every
+    side, holds any of the (n, 2) xy points.
+    """
+    x, y = xy[:, 0], xy[:, 1]
+    return np.array(
+        [
+            bool(((x >= cx1 - margin) & (x < cx2 + margin) & (y >= cy1 - margin) & (y < cy2 + margin)).any())
+            for _, (cy1, cy2, cx1, cx2) in tiles
+        ],
+        dtype=bool,
+    )
+
+
+def load_scene(path):
+    """Return an HWC RGB uint8 scene, memory-mapped when tifffile is installed and the file is uncompressed."""
+    if tifffile is not None and path.lower().endswith((".tif", ".tiff")):
+        try:
+            img = tifffile.memmap(path, mode="r")
+            if img.ndim == 3 and img.shape[2] == 3 and img.dtype == np.uint8:
+                return img
+        except ValueError:  # compressed or tiled, not memory-mappable
+            pass
+
+    return cv2.imread(path)[:, :, ::-1]  # BGR to RGB view, no copy
+
+
 class ListDataset:  # for training
     """Dataset class for loading and augmenting images and labels for training object detection models."""
 
@@ -1,6 +1,9 @@
 # Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
 
+import argparse
+import os
 import random
+import time
 
 import cv2
 import numpy as np
@@ -12,6 +15,15 @@ torch.set_printoptions(linewidth=320, precision=5, profile="long")
 np.set_printoptions(linewidth=320, formatter={"float_kind": "{:11.5g}".format})  # format short g, %precision=5
 
 
+def str2bool(v):
+    """Parses a boolean command line value, e.g. 1/0, true/false or yes/no, for argparse type=str2bool flags."""
+    if v.lower() in ("1", "true", "t", "yes", "y"):
+        return True
+    if v.lower() in ("0", "false", "f", "no", "n", ""):
+        return False
+    raise argparse.ArgumentTypeError(f"boolean value expected, got '{v}'")
+
+
 def load_classes(path):
     """Loads class labels at 'path'."""
     with open(path) as file:
@@ -34,6 +46,32 @@ def modelinfo(model):
     print(f"\n{i + 1:g} layers, {nparams:g} parameters, {ngradients:g} gradients")
 
 
+def parse_classes(spec, names):
+    """Returns sorted class indices of a comma-separated 'spec' of class indices and/or names, all classes if empty or
+    'all'.
+    """
+    if spec.strip().lower() in ("", "all"):
+        return list(range(len(names)))
+    indices = set()
+    for c in spec.split(","):
+        c = c.strip()
+        if c.isdigit():
+            assert int(c) < len(names), f"class index {c} out of range, {len(names):g} classes"
+            indices.add(int(c))
+        else:
+            assert c in names, f"unknown class '{c}', expected a name in the class file or an index"
+            indices.add(names.index(c))
+    return sorted(indices)
+
+
+def parse_formats(spec):
+    """Returns the write_detections() result formats of a comma-separated 'spec', none if empty."""
+    formats = [f.strip().lower() for f in spec.split(",") if f.strip()]
+    for f in formats:
+        assert f in ("npz", "parquet", "geojson"), f"unknown result format '{f}', expected npz, parquet or geojson"
+    return formats
+
+
 def xview_class2name(classes):
     """Converts an xView class index to its corresponding name by reading from 'data/xview.names' file."""
     with open("data/xview.names") as f:
@@ -41,9 +79,9 @@ def xview_class2name(classes):
     return x[classes].replace("\n", "")
 
 
-def xview_indices2classes(indices):  # remap xview classes 11-94 to 0-61
-    """Remaps xView class indices from 11-94 to 0-61."""
-    class_list = [
+# xView class of each class index 0-59
+XVIEW_CLASSES = np.array(
+    [
         11,
         12,
         13,
@@ -105,7 +143,12 @@ def xview_indices2classes(indices):  # remap xview classes 11-94 to 0-61
         93,
         94,
     ]
-    return class_list[indices]
+)
+
+
+def xview_indices2classes(indices):  # remap xview classes 11-94 to 0-61
+    """Remaps xView class indices from 11-94 to 0-61, for an index or an array of indices."""
+    return XVIEW_CLASSES[indices]
 
 
 def xview_class_weights(indices):  # weights of each class in the training set, normalized to mu = 1
@@ -256,11 +299,133 @@ def plot_one_box(x, im, color=None, label=None, line_thickness=None):
     c1, c2 = (int(x[0]), int(x[1])), (int(x[2]), int(x[3]))
     cv2.rectangle(im, c1, c2, color, thickness=tl)
     if label:
-        tf = max(tl - 1, 1)  # font thickness
-        t_size = cv2.getTextSize(label, 0, fontScale=tl / 3, thickness=tf)[0]
-        c2 = c1[0] + t_size[0], c1[1] - t_size[1] - 3
-        cv2.rectangle(im, c1, c2, color, -1)  # filled
-        cv2.putText(im, label, (c1[0], c1[1] - 2), 0, tl / 3, [225, 255, 255], thickness=tf, lineType=cv2.LINE_AA)
+        plot_label(c1, im, label, color, tl)
+
+
+def plot_label(c1, im, label, color, line_thickness=1):
+    """Draws a filled label box with text above the top left box corner c1, as plot_one_box()."""
+    tl = line_thickness
+    tf = max(tl - 1, 1)  # font thickness
+    t_size = cv2.getTextSize(label, 0, fontScale=tl / 3, thickness=tf)[0]
+    c2 = c1[0] + t_size[0], c1[1] - t_size[1] - 3
+    cv2.rectangle(im, c1, c2, color, -1)  # filled
+    cv2.putText(im, label, (c1[0], c1[1] - 2), 0, tl / 3, [225, 255, 255], thickness=tf, lineType=cv2.LINE_AA)
+
+
+def plot_boxes(img, boxes, colors):
+    """Draws 1 px outlines of (n, 4) x1y1x2y2 pixel boxes on img in (n, 3) colors, all edges of all boxes at once."""
+    h, w = img.shape[:2]
+    x1, y1, x2, y2 = boxes.astype(np.int64).T
+
+    def spans(lo, hi):
+        """Returns box indices and coordinates of every pixel lo..hi of each box."""
+        n = np.maximum(hi - lo + 1, 0)
+        i = np.repeat(np.arange(len(lo)), n)
+        return i, lo[i] + np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+
+    i, x = spans(np.maximum(x1, 0), np.minimum(x2, w - 1))
+    j, y = spans(np.maximum(y1, 0), np.minimum(y2, h - 1))
+    i, x, y = np.concatenate((i, i, j, j)), np.concatenate((x, x, x1[j], x2[j])), np.concatenate((y1[i], y2[i], y, y))
+    v = (x >= 0) & (x < w) & (y >= 0) & (y < h)  # edges off the image are not drawn
+    order = np.argsort(i[v], kind="stable")  # later boxes drawn over earlier ones, as a cv2.rectangle() loop
+    img[y[v][order], x[v][order]] = colors[i[v][order]]
+    return img
+
+
+def render_detections(path, detections, names, colors, output, scale=1.0, pyramid=False, tile=256):
+    """Draws (x1, y1, x2, y2, obj_conf, class_prob, class_pred) numpy detections on the image at 'path' resized by
+    'scale' and writes it to 'output', plus '{output}_pyramid/{level}/{row}_{col}.jpg' tiles of the image halved per
+    level if pyramid. Boxes are drawn by plot_boxes() in per-class 'colors', class labels only at full scale.
+    """
+    reduced = {0.5: cv2.IMREAD_REDUCED_COLOR_2, 0.25: cv2.IMREAD_REDUCED_COLOR_4, 0.125: cv2.IMREAD_REDUCED_COLOR_8}
+    img = cv2.imread(path, reduced.get(scale, cv2.IMREAD_COLOR))  # reduced while decoding where supported
+    if scale != 1 and scale not in reduced:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    boxes = np.maximum(detections[:, :4], 0) * scale
+    c = detections[:, 6].astype(np.int64)
+    plot_boxes(img, boxes, colors[c])
+    if scale >= 1:  # labels are illegible in previews
+        for box, p, k in zip(boxes, detections[:, 5], c):
+            if p > 0.05:  # outlines are drawn, only add the text
+                plot_label((int(box[0]), int(box[1])), img, f"{names[k]} {p:.2f}", colors[k].tolist())
+    cv2.imwrite(output, img)
+
+    if pyramid:
+        root, level = os.path.splitext(output)[0] + "_pyramid", 0
+        while True:
+            os.makedirs(f"{root}/{level:d}", exist_ok=True)
+            for y in range(0, img.shape[0], tile):
+                for x in range(0, img.shape[1], tile):
+                    cv2.imwrite(f"{root}/{level:d}/{y // tile:d}_{x // tile:d}.jpg", img[y : y + tile, x : x + tile])
+            if max(img.shape[:2]) <= tile:
+                break
+            img = cv2.resize(img, (max(img.shape[1] // 2, 1), max(img.shape[0] // 2, 1)), interpolation=cv2.INTER_AREA)
+            level += 1
+
+
+def write_detections(path, detections, formats=()):
+    """Writes (x1, y1, x2, y2, obj_conf, class_prob, class_pred) detections to 'path.txt' as xView 'x1 y1 x2 y2 class
+    score' lines formatted in one call, plus 'npz', 'parquet' (requires pyarrow) or 'geojson' (GeoJSON lines, pixel
+    coordinates) files at 'path' for each of 'formats'.
+    """
+    d = detections.cpu().numpy()
+    boxes = np.maximum(d[:, :4], 0)
+    xvc = xview_indices2classes(d[:, 6].astype(np.int64))  # xview class
+    score = d[:, 5] * d[:, 4]
+    rows = np.concatenate((boxes, xvc[:, None], score[:, None]), 1)
+
+    with open(f"{path}.txt", "w") as file:
+        file.write(("%g %g %g %g %g %g \n" * len(rows)) % tuple(rows.ravel().tolist()))
+
+    if "npz" in formats:
+        np.savez(f"{path}.npz", boxes=boxes, classes=xvc, scores=score)  # uncompressed, loads without decoding
+    if "parquet" in formats:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        columns = {"x1": boxes[:, 0], "y1": boxes[:, 1], "x2": boxes[:, 2], "y2": boxes[:, 3], "class": xvc}
+        pq.write_table(pa.table({**columns, "score": score}), f"{path}.parquet")
+    if "geojson" in formats:
+        feature = (
+            '{"type": "Feature", "geometry": {"type": "Polygon", "coordinates": '
+            "[[[%g, %g], [%g, %g], [%g, %g], [%g, %g], [%g, %g]]]}, "
+            '"properties": {"bounds_imcoords": "%g,%g,%g,%g", "type_id": %g, "score": %g}}\n'
+        )
+        g = rows[:, [0, 1, 2, 1, 2, 3, 0, 3, 0, 1, 0, 1, 2, 3, 4, 5]]  # closed ring, bounds, class, score
+        with open(f"{path}.geojsonl", "w") as file:
+            file.write((feature * len(g)) % tuple(g.ravel().tolist()))
+
+
+def fuse_conv_and_bn(conv, bn):
+    """Returns a Conv2d with BatchNorm2d 'bn' folded into the weights and bias of 'conv', for inference only."""
+    with torch.no_grad():
+        fused = torch.nn.Conv2d(
+            conv.in_channels,
+            conv.out_channels,
+            kernel_size=conv.kernel_size,
+            stride=conv.stride,
+            padding=conv.padding,
+            dilation=conv.dilation,
+            groups=conv.groups,
+            bias=True,
+        ).to(conv.weight.device)
+
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        fused.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        fused.bias.copy_(bn.bias + (bias - bn.running_mean) * scale)
+    return fused
+
+
+def time_forward(model, x, n=3):
+    """Returns the mean seconds per forward pass of 'model' on input 'x', after one warmup pass."""
+    with torch.no_grad():
+        model(x)
+        t = time.time()
+        for _ in range(n):
+            model(x)
+    return (time.time() - t) / n
 
 
 def weights_init_normal(m):
@@ -308,6 +473,36 @@ def compute_ap(recall, precision):
     return np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
 
 
+def box_iou(box1, box2):
+    """Returns the (n, m) IoU matrix of x1y1x2y2 boxes box1 (n, 4) and box2 (m, 4)."""
+    inter = (torch.min(box1[:, None, 2:], box2[:, 2:]) - torch.max(box1[:, None, :2], box2[:, :2])).clamp(0).prod(2)
+    area1 = (box1[:, 2] - box1[:, 0]) * (box1[:, 3] - box1[:, 1])
+    area2 = (box2[:, 2] - box2[:, 0]) * (box2[:, 3] - box2[:, 1])
+    return inter / (area1[:, None] + area2 - inter + 1e-16)
+
+
+def compare_detections(a, b, iou_thres=0.5):
+    """Compares two xView result arrays of (x1, y1, x2, y2, class, conf) rows, matching rows of 'a' and 'b' one to one
+    by greedy same-class IoU > iou_thres, best IoU first. Returns the number of matches and their mean absolute
+    confidence delta.
+    """
+    a, b = torch.from_numpy(a.reshape(-1, 6)).float(), torch.from_numpy(b.reshape(-1, 6)).float()
+    if len(a) == 0 or len(b) == 0:
+        return 0, 0.0
+    iou = (box_iou(a[:, :4], b[:, :4]) * (a[:, None, 4] == b[:, 4]).float()).numpy()
+    i, j = (iou > iou_thres).nonzero()
+    order = np.argsort(-iou[i, j], kind="stable")
+    used_a, used_b, matches = np.zeros(len(a), dtype=bool), np.zeros(len(b), dtype=bool), []
+    for k, m in zip(i[order], j[order]):
+        if not (used_a[k] or used_b[m]):
+            used_a[k] = used_b[m] = True
+            matches.append((k, m))
+    if not matches:
+        return 0, 0.0
+    k, m = np.array(matches).T
+    return len(matches), float((a[k, 5] - b[m, 5]).abs().mean())
+
+
 def bbox_iou(box1, box2, x1y1x2y2=True):
     # if len(box1.shape) == 1:
     #    box1 = box1.reshape(1, 4)
@@ -424,10 +619,88 @@ def build_targets(pred_boxes, pred_conf, pred_cls, target, anchor_wh, nA, nC, nG
     return tx, ty, tw, th, tconf, tcls, TP, FP, FN, TC
 
 
-def non_max_suppression(prediction, conf_thres=0.5, nms_thres=0.4, mat=None, img=None, model2=None, device="cpu"):
+def prior_bounds(mat, srl=3):
+    """Returns (nC, 4, 2) table of per-class log width, height, area and aspect ratio bounds, mu +/- srl sigma."""
+    mu, sigma = mat["class_mu"][:, :4], mat["class_sigma"][:, :4] * srl  # srl = sigma rejection level
+    return np.stack((mu - sigma, mu + sigma), 2)
+
+
+def prior_mask(pred, bounds, class_pred=None):
+    """Returns a boolean mask of (x, y, w, h, ...) predictions passing the size rules and the prior_bounds() of
+    class_pred, or of any class if class_pred is None.
+    """
+    w, h = pred[:, 2].cpu().numpy(), pred[:, 3].cpu().numpy()
+    a = w * h  # area
+    ar = w / (h + 1e-16)  # aspect ratio
+    v = (a > 20) & (w > 4) & (h > 4) & (ar < 10) & (ar > 1 / 10)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        f = np.stack((np.log(w), np.log(h), np.log(a), np.log(ar)), 1)[:, None]  # (n, 1, 4)
+    b = bounds[None] if class_pred is None else bounds[class_pred][:, None]  # (n or 1, nC or 1, 4, 2)
+    return v & ((f > b[..., 0]) & (f < b[..., 1])).all(2).any(1)
+
+
+def tile_prior_filter(pred, bounds, classify=True):
+    """Drops (x, y, w, h, conf, classes) tile predictions that non_max_suppression() would reject on priors, judging
+    each by its softmax class if classify, else by any class (the secondary classifier picks classes later).
+    """
+    if not classify:
+        return pred[torch.from_numpy(prior_mask(pred, bounds))]
+    class_prob, class_pred = torch.max(F.softmax(pred[:, 5:], 1), 1)
+    return pred[torch.from_numpy(prior_mask(pred, bounds, class_pred.numpy())) & (class_prob > 0.3)]
+
+
+def candidate_detections(pred, conf_thres, bounds, classes=None):
+    """Returns (x1, y1, x2, y2, obj_conf, class_prob, class_pred) detections of the (x, y, w, h, conf, classes)
+    predictions passing conf_thres, a 0.3 class probability and the prior_bounds() of their class, and their row
+    indices in pred. With 'classes', predictions whose class is not in it are dropped.
+    """
+    class_prob, class_pred = torch.max(F.softmax(pred[:, 5:], 1), 1)
+    # for i in range(len(class_prob2)):
+    #     if class_prob2[i] > class_prob[i]:
+    #         class_pred[i] = class_pred2[i]
+
+    v = ((pred[:, 4] > conf_thres) & (class_prob > 0.3)).numpy()
+    v *= prior_mask(pred, bounds, class_pred.numpy())
+    if classes is not None:
+        v *= np.isin(class_pred.numpy(), classes)
+    v = torch.from_numpy(v.nonzero()[0])
+
+    pred = pred[v]
+    class_prob = class_prob[v]
+    class_pred = class_pred[v]
+    # x, y, w, h = x[v], y[v], w[v], h[v]
+
+    # From (center x, center y, width, height) to (x1, y1, x2, y2)
+    box_corner = pred.new(len(pred), 4)
+    xy = pred[:, 0:2]
+    wh = pred[:, 2:4] / 2
+    box_corner[:, 0:2] = xy - wh
+    box_corner[:, 2:4] = xy + wh
+    pred[:, :4] = box_corner
+
+    # Detections ordered as (x1, y1, x2, y2, obj_conf, class_prob, class_pred)
+    detections = torch.cat((pred[:, :5], class_prob.float().unsqueeze(1), class_pred.float().unsqueeze(1)), 1)
+    return detections, v
+
+
+def non_max_suppression(
+    prediction,
+    conf_thres=0.5,
+    nms_thres=0.4,
+    mat=None,
+    img=None,
+    model2=None,
+    device="cpu",
+    ambiguity=(1.0, 0.0),
+    stats=None,
+    classes=None,
+):
     """Removes detections with lower object confidence score than 'conf_thres' and performs Non-Maximum Suppression to
     further filter detections.
 
+    With model2, ambiguous candidates are reclassified by it, see secondary_reclassify(). With 'classes', detections
+    of other classes are dropped after classification, the softmax still runs over all classes.
+
     Returns detections with shape:
         (x1, y1, x2, y2, object_conf, class_score, class_pred)
     """
@@ -441,34 +714,11 @@ def non_max_suppression(prediction, conf_thres=0.5, nms_thres=0.4, mat=None, img
     thresh = 0.8
     radius = 30  # area to search for cross-class ious
     # Gather bbox priors
-    srl = 3  # sigma rejection level
+    bounds = prior_bounds(mat)
     for image_i, pred in enumerate(prediction):
-        a = pred.clone()
-        a = a[np.argsort(-a[:, 4])]  # sort best to worst
-        for i in range(len(a)):
-            if i >= len(a) - 1:
-                break
-
-            close = (np.abs(a[i, 0] - a[i + 1 :, 0]) < radius) & (np.abs(a[i, 1] - a[i + 1 :, 1]) < radius)
-            close = close.nonzero()
-
-            if len(close) > 0:
-                close = close + i + 1
-                iou = bbox_iou(a[i : i + 1, :4], a[close.squeeze(), :4].reshape(-1, 4), x1y1x2y2=False)
-                bad = close[iou > thresh]
-
-                if len(bad) > 0:
-                    mask = torch.ones(len(a)).type(torch.ByteTensor)
-                    mask[bad] = 0
-                    a = a[mask]
-        pred = a
+        pred = cross_class_nms(pred, thresh, radius)
         # cross-class NMS ---------------------------------------------
 
-        x, y, w, h = pred[:, 0].numpy(), pred[:, 1].numpy(), pred[:, 2].numpy(), pred[:, 3].numpy()
-        a = w * h  # area
-        ar = w / (h + 1e-16)  # aspect ratio
-        log_w, log_h, log_a, log_ar = np.log(w), np.log(h), np.log(a), np.log(ar)
-
         # n = len(w)
         # shape_likelihood = np.zeros((n, 60), dtype=np.float32)
         # x = np.concatenate((log_w.reshape(-1, 1), log_h.reshape(-1, 1)), 1)
@@ -476,161 +726,357 @@ def non_max_suppression(prediction, conf_thres=0.5, nms_thres=0.4, mat=None, img
         # for c in range(60):
         # shape_likelihood[:, c] = multivariate_normal.pdf(x, mean=mat['class_mu'][c, :2], cov=mat['class_cov'][c, :2, :2])
 
-        if model2 is None:
-            class_prob, class_pred = torch.max(F.softmax(pred[:, 5:], 1), 1)
-        else:
-            # Start secondary classification of each chip
-            class_prob, class_pred = secondary_class_detection(x, y, w, h, img.copy(), model2, device)
-            # for i in range(len(class_prob2)):
-            #     if class_prob2[i] > class_prob[i]:
-            #         class_pred[i] = class_pred2[i]
-
-        mu = mat["class_mu"][class_pred].T
-        sigma = mat["class_sigma"][class_pred].T * srl
-
-        v = ((pred[:, 4] > conf_thres) & (class_prob > 0.3)).numpy()
-        v *= (a > 20) & (w > 4) & (h > 4) & (ar < 10) & (ar > 1 / 10)
-        v *= (log_w > mu[0] - sigma[0]) & (log_w < mu[0] + sigma[0])
-        v *= (log_h > mu[1] - sigma[1]) & (log_h < mu[1] + sigma[1])
-        v *= (log_a > mu[2] - sigma[2]) & (log_a < mu[2] + sigma[2])
-        v *= (log_ar > mu[3] - sigma[3]) & (log_ar < mu[3] + sigma[3])
-        v = v.nonzero()
-
-        pred = pred[v]
-        class_prob = class_prob[v]
-        class_pred = class_pred[v]
-        # x, y, w, h = x[v], y[v], w[v], h[v]
+        if model2 is not None:
+            # Start secondary classification of each ambiguous chip
+            pred = secondary_reclassify(pred, img, model2, device, ambiguity, stats)
+        detections = candidate_detections(pred, conf_thres, bounds, classes)[0]
 
         # If none are remaining => process next image
-        nP = pred.shape[0]
-        if not nP:
+        if not len(detections):
             continue
 
-        # From (center x, center y, width, height) to (x1, y1, x2, y2)
-        box_corner = pred.new(nP, 4)
-        xy = pred[:, 0:2]
-        wh = pred[:, 2:4] / 2
-        box_corner[:, 0:2] = xy - wh
-        box_corner[:, 2:4] = xy + wh
-        pred[:, :4] = box_corner
-
-        # Detections ordered as (x1, y1, x2, y2, obj_conf, class_prob, class_pred)
-        detections = torch.cat((pred[:, :5], class_prob.float().unsqueeze(1), class_pred.float().unsqueeze(1)), 1)
-        # Iterate through all predicted classes
-        unique_labels = detections[:, -1].cpu().unique()
-        if prediction.is_cuda:
-            unique_labels = unique_labels.cuda()
-        for c in unique_labels:
-            # Get the detections with the particular class
-            detections_class = detections[detections[:, -1] == c]
-            # Sort the detections by maximum objectness confidence
-            _, conf_sort_index = torch.sort(detections_class[:, 4], descending=True)
-            detections_class = detections_class[conf_sort_index]
-            # Perform non-maximum suppression
-            max_detections = []
-
-            # print(detections_class)
-            while detections_class.shape[0]:
-                # Get detection with highest confidence and save as max detection
-                max_detections.append(detections_class[0].unsqueeze(0))
-                # Stop if we're at the last detection
-                if len(detections_class) == 1:
-                    break
-                # Get the IOUs for all boxes with lower confidence
-                ious = bbox_iou(max_detections[-1], detections_class[1:])
-
-                # Remove detections with IoU >= NMS threshold
-                detections_class = detections_class[1:][ious < nms_thres]
-
-            max_detections = torch.cat(max_detections).data
-            # print(max_detections)
-            # Add max detections to outputs
-            output[image_i] = (
-                max_detections if output[image_i] is None else torch.cat((output[image_i], max_detections))
-            )
-
-            # # NMS2
-            # for c in unique_labels:
-            #     # Get the detections with the particular class
-            #     detections_class = detections[detections[:, -1] == c]
-            #     # Sort the detections by maximum objectness confidence
-            #     _, conf_sort_index = torch.sort(detections_class[:, 4], descending=True)
-            #     detections_class = detections_class[conf_sort_index]
-            #     # Perform non-maximum suppression
-            #     max_detections = []
-            #
-            #     while detections_class.shape[0]:
-            #         if len(detections_class) == 1:
-            #             break
-            #
-            #         ious = bbox_iou(detections_class[0:1], detections_class[1:])
-            #
-            #         if ious.max() > 0.5:
-            #             max_detections.append(detections_class[0].unsqueeze(0))
-            #
-            #         # Remove detections with IoU >= NMS threshold
-            #         detections_class = detections_class[1:][ious < nms_thres]
-            #
-            #     if len(max_detections) > 0:
-            #         max_detections = torch.cat(max_detections).data
-            #         # Add max detections to outputs
-            #         output[image_i] = max_detections if output[image_i] is None else torch.cat(
-            #             (output[image_i], max_detections))
+        # Per-class NMS of all classes at once
+        output[image_i] = batched_nms(detections, nms_thres)
+
+        # # NMS2
+        # for c in unique_labels:
+        #     # Get the detections with the particular class
+        #     detections_class = detections[detections[:, -1] == c]
+        #     # Sort the detections by maximum objectness confidence
+        #     _, conf_sort_index = torch.sort(detections_class[:, 4], descending=True)
+        #     detections_class = detections_class[conf_sort_index]
+        #     # Perform non-maximum suppression
+        #     max_detections = []
+        #
+        #     while detections_class.shape[0]:
+        #         if len(detections_class) == 1:
+        #             break
+        #
+        #         ious = bbox_iou(detections_class[0:1], detections_class[1:])
+        #
+        #         if ious.max() > 0.5:
+        #             max_detections.append(detections_class[0].unsqueeze(0))
+        #
+        #         # Remove detections with IoU >= NMS threshold
+        #         detections_class = detections_class[1:][ious < nms_thres]
+        #
+        #     if len(max_detections) > 0:
+        #         max_detections = torch.cat(max_detections).data
+        #         # Add max detections to outputs
+        #         output[image_i] = max_detections if output[image_i] is None else torch.cat(
+        #             (output[image_i], max_detections))
+
+    return output
+
+
+class StreamingNMS:
+    """Incremental non_max_suppression() of a top-to-bottom tile scan, approximating whole-scene NMS in bounded memory.
+    Detections whose centers lie more than 'margin' above the scan frontier are emitted and never revisited. Their rows
+    stay in memory for one more margin as suppressors: detections in both NMS stages, other cross-class survivors in
+    cross-class NMS only. Rows already suppressed are dropped, so they can never suppress a later box.
 
+    Greedy NMS decides a row through chains of suppressors that can reach past 'margin', e.g. a dense column of boxes
+    growing in confidence downward, where a later box frees a row that was emitted as suppressed. Results may then
+    differ from a single non_max_suppression() call.
+    """
+
+    def __init__(
+        self,
+        conf_thres=0.5,
+        nms_thres=0.4,
+        mat=None,
+        img=None,
+        model2=None,
+        device="cpu",
+        margin=None,
+        ambiguity=(1.0, 0.0),
+        stats=None,
+        classes=None,
+    ):
+        """Initializes with non_max_suppression() arguments, margin defaults to the tallest prior box height."""
+        self.conf_thres, self.nms_thres, self.bounds, self.classes = conf_thres, nms_thres, prior_bounds(mat), classes
+        self.secondary = (img, model2, device, ambiguity, stats) if model2 is not None else None
+        self.margin = max(np.exp(self.bounds[:, 1, 1].max()), 30) if margin is None else margin  # >= radius
+        self.pending, self.buffer, self.output = [], None, []
+        self.classified = torch.zeros(0, dtype=torch.bool)  # buffer rows already offered to model2
+        self.state = torch.zeros(0, dtype=torch.uint8)  # 0 undecided, 1 final cross-class survivor, 2 final detection
+        self.done = -float("inf")  # detections above this y have been emitted
+
+    def add(self, pred):
+        """Adds (n, 5 + nC) tile predictions (x, y, w, h, conf, classes) in scene coordinates."""
+        self.pending.append(pred.cpu())
+
+    def flush(self, frontier=float("inf")):
+        """Emits detections centered above frontier - margin, given that no later box is centered above 'frontier'."""
+        cut = frontier - self.margin
+        if cut <= self.done:  # frontier has not moved, nothing to emit
+            return
+        if self.pending:
+            pending, self.pending = torch.cat(self.pending), []
+            self.buffer = pending if self.buffer is None else torch.cat((self.buffer, pending))
+            self.classified = torch.cat((self.classified, torch.zeros(len(pending), dtype=torch.bool)))
+            self.state = torch.cat((self.state, torch.zeros(len(pending), dtype=torch.uint8)))
+        if self.buffer is None:
+            return
+        buffer, n = self.buffer, len(self.buffer)
+
+        # Cross-class NMS, then reclassify its new survivors once, as non_max_suppression()
+        index = torch.arange(n, dtype=buffer.dtype)[:, None]
+        s = cross_class_nms(torch.cat((buffer[:, :5], index), 1))[:, 5].long()  # survivors, best first
+        if self.secondary is not None:
+            i = s[~self.classified[s]]
+            if len(i):
+                buffer[i] = secondary_reclassify(buffer[i], *self.secondary)
+                self.classified[i] = True
+
+        # Per-class NMS of the candidates, final survivors that were not detections take no part
+        s = s[self.state[s] != 1]
+        detections, i = candidate_detections(buffer[s], self.conf_thres, self.bounds, self.classes)
+        kept = torch.zeros(n, dtype=torch.bool)
+        if len(detections):
+            # batched_nms() reads boxes, confidence and the last (class) column, row indices are carried along
+            d = torch.cat((detections[:, :6], s[i, None].to(detections.dtype), detections[:, 6:]), 1)
+            d = batched_nms(d, self.nms_thres)
+            k = d[:, 6].long()
+            kept[k] = True
+            new = (self.state[k] == 0) & (buffer[k, 1] < cut)  # not emitted by an earlier flush
+            self.output.append(d[new][:, [0, 1, 2, 3, 4, 5, 7]])
+
+        # Rows centered above cut are decided, keep the suppressors among them for context
+        survivor = torch.zeros(n, dtype=torch.bool)
+        survivor[s] = True
+        decided = (self.state == 0) & (buffer[:, 1] < cut)
+        self.state[decided & survivor] = 1
+        self.state[decided & kept] = 2
+        v = (buffer[:, 1] >= cut) | ((buffer[:, 1] >= cut - self.margin) & (self.state > 0))
+        self.buffer, self.classified, self.state = buffer[v], self.classified[v], self.state[v]
+        self.done = cut
+
+    def result(self):
+        """Returns all detections ordered by class, then confidence, as non_max_suppression(), or None."""
+        self.flush()
+        if not self.output:
+            return None
+        detections = torch.cat(self.output)
+        detections = detections[torch.sort(detections[:, 4], descending=True, stable=True)[1]]
+        return detections[torch.sort(detections[:, -1], stable=True)[1]] if len(detections) else None
+
+
+def nms_loop(detections, nms_thres=0.4):
+    """Reference per-class NMS of (x1, y1, x2, y2, obj_conf, class_prob, class_pred) detections, looping over classes
+    and suppressing one box at a time. Superseded by batched_nms(), kept for benchmark_nms().
+    """
+    output = None
+    for c in detections[:, -1].cpu().unique():
+        # Get the detections with the particular class
+        detections_class = detections[detections[:, -1] == c]
+        # Sort the detections by maximum objectness confidence
+        _, conf_sort_index = torch.sort(detections_class[:, 4], descending=True, stable=True)
+        detections_class = detections_class[conf_sort_index]
+        # Perform non-maximum suppression
+        max_detections = []
+
+        while detections_class.shape[0]:
+            # Get detection with highest confidence and save as max detection
+            max_detections.append(detections_class[0].unsqueeze(0))
+            # Stop if we're at the last detection
+            if len(detections_class) == 1:
+                break
+            # Get the IOUs for all boxes with lower confidence
+            ious = bbox_iou(max_detections[-1], detections_class[1:])
+
+            # Remove detections with IoU >= NMS threshold
+            detections_class = detections_class[1:][ious < nms_thres]
+
+        max_detections = torch.cat(max_detections).data
+        output = max_detections if output is None else torch.cat((output, max_detections))
     return output
 
 
+def batched_nms(detections, nms_thres=0.4):
+    """Per-class NMS of (x1, y1, x2, y2, obj_conf, class_prob, class_pred) detections for all classes at once, removing
+    boxes with IoU >= nms_thres to a better kept box of the same class. Box centers are scaled by the largest box extent
+    of their class and offset per class, so one grid_pairs() call yields every same-class pair that could overlap.
+    Returns kept detections ordered by class, then confidence, as nms_loop().
+    """
+    order = torch.sort(detections[:, 4], descending=True, stable=True)[1]
+    order = order[np.argsort(detections[order, -1].cpu().numpy(), kind="stable")]
+    d = detections[order]
+    if len(d) < 2:
+        return d
+
+    b = d[:, :4].cpu().numpy().astype(np.float64)
+    c = d[:, -1].cpu().numpy().astype(np.int64)
+    extent = np.zeros(c.max() + 1)
+    np.maximum.at(extent, c, np.maximum(b[:, 2] - b[:, 0], b[:, 3] - b[:, 1]))
+    xy = ((b[:, :2] + b[:, 2:]) / 2) / np.maximum(extent[c], 1e-6)[:, None]  # overlapping boxes are < 1 apart
+    xy[:, 0] += c * (xy[:, 0].max() - xy[:, 0].min() + 3)  # classes never share or neighbour a grid cell
+
+    i, j = grid_pairs(xy, 1.0)
+    i, j = torch.from_numpy(i), torch.from_numpy(j)
+    bad = bbox_iou(d[i, :4], d[j, :4]) >= nms_thres
+    return d[torch.from_numpy(greedy_keep(len(d), i[bad].numpy(), j[bad].numpy()))]
+
+
+def benchmark_nms(n=5000, nc=60, size=3000, nms_thres=0.4, seed=0):
+    """Times nms_loop() against batched_nms() on a synthetic dense scene of n boxes in nc classes, checking that both
+    return the same detections.
+    """
+    rng = np.random.RandomState(seed)
+    xy = rng.rand(n, 2) * size
+    wh = rng.rand(n, 2) * 40 + 10
+    xy = np.concatenate((xy, xy + rng.randn(n, 2) * 5))  # near duplicates to suppress
+    wh = np.concatenate((wh, wh))
+    detections = np.concatenate(
+        (xy - wh / 2, xy + wh / 2, rng.rand(2 * n, 2), rng.randint(nc, size=(2 * n, 1))), 1
+    ).astype(np.float32)
+    detections = torch.from_numpy(detections)
+
+    t = time.time()
+    a = nms_loop(detections, nms_thres)
+    t1 = time.time() - t
+    t = time.time()
+    b = batched_nms(detections, nms_thres)
+    t2 = time.time() - t
+    print(
+        f"{2 * n:g} boxes -> {len(b):g} kept, loop {t1:.3f}s, batched {t2:.3f}s ({t1 / t2:.1f}x), "
+        f"equal {torch.equal(a, b)}"
+    )
+
+
+def greedy_keep(n, i, j):
+    """Resolves greedy NMS over n score-sorted boxes from suppression edges i -> j (i ranked above j), returning a
+    boolean keep mask where a box is kept unless a kept, higher ranked box suppresses it.
+    """
+    keep = np.ones(n, dtype=bool)
+    if len(i) == 0:
+        return keep
+
+    order = np.argsort(i, kind="stable")  # group edges by suppressing box, best first
+    i, j = i[order], j[order]
+    sources, start = np.unique(i, return_index=True)
+    end = np.append(start[1:], len(i))
+    for k, a, b in zip(sources, start, end):
+        if keep[k]:
+            keep[j[a:b]] = False
+    return keep
+
+
+def grid_pairs(xy, radius):
+    """Returns index pairs (i, j), i < j, of points xy (n, 2) lying in the same or adjacent cells of a radius-sized
+    grid, a superset of all pairs closer than radius in both x and y.
+    """
+    cell = np.floor(xy / radius).astype(np.int64)
+    cell -= cell.min(0) - 1  # neighbours of every cell have non-negative coordinates
+    m = cell[:, 1].max() + 2
+    key = cell[:, 0] * m + cell[:, 1]
+    order = np.argsort(key, kind="stable")
+    sorted_key = key[order]
+
+    i, j = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbour = key + dx * m + dy
+            lo = np.searchsorted(sorted_key, neighbour, "left")
+            counts = np.searchsorted(sorted_key, neighbour, "right") - lo
+            src = np.repeat(np.arange(len(xy)), counts)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            dst = order[np.repeat(lo, counts) + offsets]
+            v = src < dst
+            i.append(src[v])
+            j.append(dst[v])
+    return np.concatenate(i), np.concatenate(j)
+
+
+def cross_class_nms(pred, iou_thres=0.8, radius=30):
+    """Sorts xywh predictions best to worst and greedily removes any box with IoU > iou_thres to a better kept box of
+    any class whose center lies within radius in x and y, using a grid over box centers to find candidate pairs.
+    """
+    a = pred[np.argsort(-pred[:, 4], kind="stable")]  # sort best to worst, ties in input order
+    if len(a) < 2:
+        return a
+
+    i, j = grid_pairs(a[:, :2].numpy(), radius)
+    i, j = torch.from_numpy(i), torch.from_numpy(j)
+    close = ((a[i, 0] - a[j, 0]).abs() < radius) & ((a[i, 1] - a[j, 1]).abs() < radius)
+    i, j = i[close], j[close]
+    bad = bbox_iou(a[i, :4], a[j, :4], x1y1x2y2=False) > iou_thres
+    return a[torch.from_numpy(greedy_keep(len(a), i[bad].numpy(), j[bad].numpy()))]
+
+
+def secondary_reclassify(pred, img, model2, device, ambiguity=(1.0, 0.0), stats=None):
+    """Returns (x, y, w, h, conf, class logits) predictions with the class logits of ambiguous candidates, whose primary
+    class probability is at most ambiguity[0] or top-2 probability margin is below ambiguity[1], replaced by model2
+    log-probabilities from secondary_class_detection(). Counts of 'chips' reclassified and 'gated' candidates and the
+    secondary classifier 'time' are added to the 'stats' dict, if given.
+    """
+    top = torch.topk(F.softmax(pred[:, 5:], 1), min(2, pred.shape[1] - 5), 1)[0]
+    i = ((top[:, 0] <= ambiguity[0]) | (top[:, 0] - top[:, -1] < ambiguity[1])).nonzero().view(-1)
+    if len(i):
+        t = time.time()
+        x, y, w, h = (pred[i, k].numpy() for k in range(4))
+        pred = pred.clone()
+        pred[i, 5:] = F.log_softmax(secondary_class_detection(x, y, w, h, img, model2, device), 1)
+        if stats is not None:
+            stats["time"] += time.time() - t  # classifier calls only, the per chip time of savings estimates
+    if stats is not None:
+        stats["chips"] += len(i)
+        stats["gated"] += len(pred) - len(i)
+    return pred
+
+
 # @profile
-def secondary_class_detection(x, y, w, h, img, model, device):
-    """Detect secondary classes from input image chips using a specified model and device, returning class predictions."""
-    img = np.ascontiguousarray(img.transpose([1, 2, 0]))  # torch to cv2
+def secondary_class_detection(x, y, w, h, img, model, device, max_memory=2**30):
+    """Detect secondary classes from input image chips using a specified model and device, returning class logits.
+    Chips are cropped from LazyScene 'img' by roi_crops() in chunks sized to keep activations under max_memory bytes.
+    """
     height = 64
+    H, W = img.shape[1:]
 
     l = np.round(np.maximum(w, h) + 2) / 2
     x1 = np.maximum(x - l, 1).astype(np.uint16)
-    x2 = np.minimum(x + l, img.shape[1]).astype(np.uint16)
+    x2 = np.minimum(x + l, W).astype(np.uint16)
     y1 = np.maximum(y - l, 1).astype(np.uint16)
-    y2 = np.minimum(y + l, img.shape[0]).astype(np.uint16)
+    y2 = np.minimum(y + l, H).astype(np.uint16)
 
     n = len(x)
-    images = [
-        cv2.resize(
-            img[y1[i] : y2[i], x1[i] : x2[i]],
-            (height, height),
-            interpolation=cv2.INTER_LINEAR,
-        )
-        for i in range(n)
-    ]
-    # # plot
-    # images_numpy = images.copy()
-    # import matplotlib.pyplot as plt
-    # rgb_mean = [60.134, 49.697, 40.746]
-    # rgb_std = [29.99, 24.498, 22.046]
-    # for i in range(36):
-    #     im = images_numpy[i + 300].copy()
-    #     for j in range(3):
-    #         im[:, :, j] *= rgb_std[j]
-    #         im[:, :, j] += rgb_mean[j]
-    #
-    #     im /= 255
-    #     plt.subplot(6, 6, i + 1).imshow(im)
-
-    images = np.stack(images).transpose([0, 3, 1, 2])  # cv2 to pytorch
-    images = np.ascontiguousarray(images)
-    images = torch.from_numpy(images).to(device)
-
+    chunk = max(max_memory // (2 * 64 * height**2 * 4), 1)  # two float32 64-channel maps at chip size per chip
     with torch.no_grad():
         classes = []
-        nB = n // 500 + 1
-        for i in range(nB):
-            # print(i,nB)
-            j0 = int(i * 500)
-            j1 = int(min(j0 + 500, n))
-            im = images[j0:j1]
-            classes.append(model(im).cpu())
-
-        classes = torch.cat(classes, 0)
-    return torch.max(F.softmax(classes, 1), 1)
+        for j0 in range(0, n, chunk):
+            j = slice(j0, j0 + chunk)
+            im = torch.from_numpy(roi_crops(img, x1[j], y1[j], x2[j], y2[j], height)).to(device)
+            c = model(im).cpu()
+            classes.append(c.view(len(im), -1))
+
+    return torch.cat(classes, 0) if classes else torch.zeros(0, 60)
+
+
+def roi_crops(img, x1, y1, x2, y2, size=64):
+    """Returns (n, 3, size, size) float32 RGB normalized crops img[y1:y2, x1:x2] of LazyScene 'img', resized as
+    cv2.resize(INTER_LINEAR) by gathering only the sampled pixels from the uint8 scene, with no full-scene copy.
+    """
+    s = (np.arange(size, dtype=np.float32) + 0.5) / size  # output pixel centers, fraction of the crop
+
+    def sample(a, b):
+        """Returns (n, size) neighbour indices i0, i1 and weights f of crops [a, b) along one axis."""
+        a, b = a.astype(np.int64)[:, None], b.astype(np.int64)[:, None]
+        p = np.clip(a + s * (b - a) - 0.5, a, b - 1)  # border pixels replicated, as cv2
+        i0 = np.floor(p).astype(np.int64)
+        return i0, np.minimum(i0 + 1, b - 1), (p - i0)[..., None]
+
+    yi0, yi1, fy = sample(y1, y2)
+    xi0, xi1, fx = sample(x1, x2)
+    yi0, yi1, fy = yi0[:, :, None], yi1[:, :, None], fy[:, :, None]  # (n, size, 1, 1)
+    xi0, xi1 = xi0[:, None], xi1[:, None]  # (n, 1, size)
+    fx = fx[:, None]
+
+    top = img.img[yi0, xi0] * (1 - fx) + img.img[yi0, xi1] * fx
+    bottom = img.img[yi1, xi0] * (1 - fx) + img.img[yi1, xi1] * fx
+    crops = (top * (1 - fy) + bottom * fy).astype(np.float32)  # (n, size, size, 3)
+    crops -= img.rgb_mean.ravel()
+    crops /= img.rgb_std.ravel()
+    return np.ascontiguousarray(crops.transpose(0, 3, 1, 2))
 
 
 def createChips():